@@ -1,28 +1,77 @@
+import functools
+import hashlib
 import logging
+import math
+import random
+import re
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+import orjson
 import requests
 from django.conf import settings
 from django.core.cache import cache
-from django.http import JsonResponse
-from django.views.decorators.cache import never_cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views.decorators.cache import cache_control
 from django.views.decorators.http import require_GET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 log = logging.getLogger(__name__)
 
 # ---- Defaults (overridable via Django settings) ----
 DEFAULTS = {
     "CACHE_KEY": "upvx:courses_all:v1",
-    "STALE_KEY": "upvx:courses_all:stale:v1",
+    "FRESH_KEY": "upvx:courses_all:fresh_until:v1",
     "LOCK_KEY": "upvx:courses_all:lock:v1",
-    "CACHE_TTL_SECONDS": 15 * 60,          # fresh TTL
-    "STALE_TTL_SECONDS": 24 * 60 * 60,     # stale TTL
+    "CACHE_TTL_SECONDS": 15 * 60,          # fresh TTL (lifetime of FRESH_KEY)
+    "STALE_TTL_SECONDS": 24 * 60 * 60,     # stale TTL (lifetime of CACHE_KEY)
     "LOCK_TTL_SECONDS": 20,                # lock TTL
-    "REQUEST_TIMEOUT_SECONDS": 8,          # upstream API timeout
+    "LOCAL_TTL_SECONDS": 5,                # per-process copy, served without touching the cache
+    "CONNECT_TIMEOUT_SECONDS": 2,          # upstream API connect timeout
+    "REQUEST_TIMEOUT_SECONDS": 8,          # upstream API read timeout
     "PAGE_SIZE": 100,
+    "FETCH_WORKERS": 8,                    # parallel upstream page requests
     "API_PATH": "/api/courses/v1/courses/",  # public in your case
+    "SOURCE": "api",                       # "api" (HTTP Courses API) | "course_overview" (in-process get_courses)
+    "FIELDS": None,                        # Courses API keys to keep per course; None keeps all
 }
 
+# Layout of the value stored under CACHE_KEY (see _encode_catalog). Part of the
+# key itself, so entries written by an older layout are never read back, even
+# when COURSE_CATALOG_CACHE_CACHE_KEY is overridden.
+_CATALOG_FORMAT = 5
+
+# Fields read from each CourseOverview when SOURCE is "course_overview".
+COURSE_OVERVIEW_FIELDS = (
+    "id",
+    "display_name",
+    "org",
+    "start",
+    "end",
+    "short_description",
+    "course_image_url",
+)
+
+
+# gzip member header: deflate, no flags, no mtime, unknown OS (RFC 1952)
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+_ACCEPTS_GZIP = re.compile(r"\bgzip\b")  # same check as django.middleware.gzip
+
+# Per-process copy of the last catalog served: (catalog, source, time.monotonic()
+# expiry). Swapped as a whole so concurrent request threads never see a mixed tuple.
+_local_copy = (None, None, 0.0)
+
+# Background refreshes (stale-while-revalidate) run here, off the request thread.
+_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="course_catalog_cache")
+
 
 def _cfg(name: str):
     """
@@ -32,8 +81,49 @@ def _cfg(name: str):
     return getattr(settings, f"COURSE_CATALOG_CACHE_{name}", DEFAULTS[name])
 
 
+def _catalog_key():
+    return f"{_cfg('CACHE_KEY')}:fmt{_CATALOG_FORMAT}"
+
+
+def _build_session():
+    """
+    One keep-alive pool shared by all page fetches and refreshes, sized to
+    FETCH_WORKERS so parallel pagination never opens throwaway connections.
+    requests has no timeout for waiting on a pooled connection, so the pool
+    doesn't block: any overflow gets a one-off connection instead of queuing.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=int(_cfg("FETCH_WORKERS")),
+        pool_block=False,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,  # let _get_courses_page report the final status
+        ),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _build_session()
+
+
+# (epoch second, its ISO string): responses share one formatted timestamp per second
+_now_iso_cache = (0, "")
+
+
 def _now_iso():
-    return datetime.now(timezone.utc).isoformat()
+    global _now_iso_cache
+    second = int(time.time())
+    cached_second, iso = _now_iso_cache
+    if second != cached_second:
+        iso = datetime.fromtimestamp(second, timezone.utc).isoformat()
+        _now_iso_cache = (second, iso)
+    return iso
 
 
 def _get_site_root():
@@ -50,33 +140,76 @@ def _build_internal_url(request, path, query: str = ""):
     return f"{scheme}://{host}{path}{query}"
 
 
+@functools.lru_cache(maxsize=1)
+def _configured_api_url():
+    """
+    Courses API URL built from LMS_ROOT_URL, the usual production setup.
+    Settings don't change at runtime, so it is resolved once per process.
+    Empty when there is no site root to build it from.
+    """
+    root = _get_site_root()
+    return f"{root}{_cfg('API_PATH')}" if root else ""
+
+
+def _api_url(request):
+    return _configured_api_url() or _build_internal_url(request, _cfg("API_PATH"))
+
+
+def _get_courses_page(session, url, page):
+    timeout = (float(_cfg("CONNECT_TIMEOUT_SECONDS")), float(_cfg("REQUEST_TIMEOUT_SECONDS")))
+    resp = session.get(url, timeout=timeout)
+    if resp.status_code != 200:
+        raise RuntimeError(
+            f"Courses API failed page={page} status={resp.status_code} body={resp.text[:300]}"
+        )
+
+    data = orjson.loads(resp.content)
+    results = data.get("results") or []
+    if not isinstance(results, list):
+        results = []
+
+    return data, results
+
+
 def _fetch_all_courses_from_courses_api(request):
     """
     Calls the LMS Courses API and paginates server-side.
     This runs only on cache refresh (not per end-user request).
     Assumes the endpoint is public (no auth required).
+
+    The first page tells how many pages there are; the rest are fetched in
+    parallel. If the API reports no usable total, follow `next` links instead.
     """
     page_size = int(_cfg("PAGE_SIZE"))
-    api_path = _cfg("API_PATH")
+    api_url = _api_url(request)
 
-    url = _build_internal_url(request, api_path, query=f"?page_size={page_size}")
+    url = f"{api_url}?page_size={page_size}"
 
-    session = requests.Session()
-    all_results = []
-    page = 1
+    session = _SESSION
+    data, all_results = _get_courses_page(session, url, page=1)
+    pagination = data.get("pagination") or {}
 
-    while url:
-        resp = session.get(url, timeout=float(_cfg("REQUEST_TIMEOUT_SECONDS")))
-        if resp.status_code != 200:
-            raise RuntimeError(
-                f"Courses API failed page={page} status={resp.status_code} body={resp.text[:300]}"
-            )
+    num_pages = pagination.get("num_pages")
+    if num_pages is None and pagination.get("count") is not None and all_results:
+        # Page 1 holds as many courses as the server's effective page size,
+        # which may be smaller than PAGE_SIZE if it clamps page_size
+        num_pages = math.ceil(int(pagination["count"]) / len(all_results))
+
+    if num_pages is not None:
+        pages = range(2, int(num_pages) + 1)
+        urls = [f"{api_url}?page={page}&page_size={page_size}" for page in pages]
+        if urls:
+            workers = min(int(_cfg("FETCH_WORKERS")), len(urls))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _, results in executor.map(_get_courses_page, [session] * len(urls), urls, pages):
+                    all_results.extend(results)
+        return all_results
 
-        data = resp.json()
-        results = data.get("results") or []
-        if not isinstance(results, list):
-            results = []
+    url = pagination.get("next")
+    page = 2
 
+    while url:
+        data, results = _get_courses_page(session, url, page)
         all_results.extend(results)
 
         pagination = data.get("pagination") or {}
@@ -86,53 +219,240 @@ def _fetch_all_courses_from_courses_api(request):
     return all_results
 
 
-def _json_response(results, source, http_status=200):
-    payload = {
-        "count": len(results),
-        "results": results,
-        "source": source,  # "cache" | "fresh" | "stale"
-        "generated_at": _now_iso(),
-        "version": 1,
+def _fetch_all_courses_from_course_overviews():
+    """
+    Reads the catalog from CourseOverview in this LMS process, skipping the
+    HTTP loopback, DRF serialization and JSON round-trip.
+
+    Courses are selected by the LMS's own get_courses() for an anonymous user,
+    the path the Courses API takes: the site's org filter plus has_access()
+    with the configured COURSE_CATALOG_VISIBILITY_PERMISSION. Sorted by id so
+    an unchanged catalog always encodes (and hashes) the same way.
+    """
+    from django.contrib.auth.models import AnonymousUser
+    from lms.djangoapps.courseware.courses import get_courses
+
+    overviews = sorted(get_courses(AnonymousUser()), key=lambda overview: str(overview.id))
+    return [
+        dict(
+            {field: getattr(overview, field) for field in COURSE_OVERVIEW_FIELDS},
+            id=str(overview.id),
+        )
+        for overview in overviews
+    ]
+
+
+def _fetch_all_courses(request):
+    """
+    Fetches the catalog from the configured SOURCE. "course_overview" falls
+    back to the Courses API where the LMS is not importable.
+    """
+    if _cfg("SOURCE") == "course_overview":
+        try:
+            return _fetch_all_courses_from_course_overviews()
+        except ImportError:
+            log.warning("course_catalog_cache: LMS course listing not available, using the Courses API")
+
+    results = _fetch_all_courses_from_courses_api(request)
+
+    # Keep only what consumers use: smaller cache entry, less to encode and ship
+    fields = _cfg("FIELDS")
+    if fields:
+        results = [{key: course.get(key) for key in fields} for course in results]
+
+    return results
+
+
+def _deflate(data, final):
+    """
+    Raw deflate stream. Non-final streams end on a sync flush (byte aligned,
+    no last-block bit) so another stream can be appended to them.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def _encode_catalog(results, previous=None):
+    """
+    Serializes and compresses the catalog once per refresh into the leading
+    part of the response body, `{"count":N,"results":[...]`. Cache hits only
+    append the per-response fields (see _json_response) instead of
+    re-encoding or re-compressing the list.
+
+    If the content matches `previous` (the catalog being refreshed), that
+    entry is returned as is, skipping compression.
+    """
+    results_json = orjson.dumps(results, default=DjangoJSONEncoder().default)
+    head = b'{"count":%d,"results":%b' % (len(results), results_json)
+    # Weak: source/generated_at differ between otherwise identical bodies
+    etag = 'W/"%s"' % hashlib.blake2b(head, digest_size=16).hexdigest()
+
+    if previous is not None and previous["etag"] == etag:
+        return previous
+
+    return {
+        "deflated": _deflate(head, final=False),
+        "crc32": zlib.crc32(head),
+        "size": len(head),
+        "etag": etag,
     }
-    return JsonResponse(payload, status=http_status, json_dumps_params={"ensure_ascii": False})
+
+
+def _etag_matches(request, etag):
+    """
+    Weak comparison against If-None-Match (RFC 9110 13.1.2).
+    """
+    etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    if "*" in etags:
+        return True
+    opaque = etag[2:]
+    return any((tag[2:] if tag.startswith("W/") else tag) == opaque for tag in etags)
+
+
+def _json_response(request, catalog, source, http_status=200):
+    """
+    gzip clients get the cached deflate stream as is, completed with the
+    deflated tail and a gzip trailer whose CRC extends the stored one. Others
+    get it inflated. Clients already holding this catalog get a 304.
+    """
+    if _etag_matches(request, catalog["etag"]):
+        response = HttpResponseNotModified()
+        response["ETag"] = catalog["etag"]
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+
+    tail = b"," + orjson.dumps(
+        {
+            "source": source,  # "cache" | "fresh" | "stale"
+            "generated_at": _now_iso(),
+            "version": 1,
+        }
+    )[1:]
+
+    if _ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        trailer = struct.pack(
+            "<II",
+            zlib.crc32(tail, catalog["crc32"]),
+            (catalog["size"] + len(tail)) & 0xFFFFFFFF,
+        )
+        body = _GZIP_HEADER + catalog["deflated"] + _deflate(tail, final=True) + trailer
+        response = HttpResponse(body, status=http_status, content_type="application/json; charset=utf-8")
+        response["Content-Encoding"] = "gzip"
+    else:
+        head = zlib.decompressobj(-zlib.MAX_WBITS).decompress(catalog["deflated"])
+        response = HttpResponse(head + tail, status=http_status, content_type="application/json; charset=utf-8")
+
+    response["ETag"] = catalog["etag"]
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def _jittered_ttl(name):
+    """
+    TTL setting +/-10%, so expirations (and the refreshes they trigger) don't
+    all line up on the same instant.
+    """
+    return int(int(_cfg(name)) * random.uniform(0.9, 1.1))
+
+
+def _store_catalog(catalog, unchanged=False):
+    """
+    CACHE_KEY keeps the encoded catalog for STALE_TTL_SECONDS so it can always
+    be served; FRESH_KEY is a short-lived marker telling whether it is due for
+    a refresh. The catalog is stored deflated (see _encode_catalog), which
+    cuts cache memory and the bytes shipped on every hit. FRESH_KEY holds the
+    catalog ETag so processes can check their local copy without fetching it.
+
+    An `unchanged` catalog only gets its CACHE_KEY expiry pushed back instead
+    of being written again, and since its ETag stays the same, every local
+    copy stays valid too.
+    """
+    cache_key = _catalog_key()
+    stale_ttl = _jittered_ttl("STALE_TTL_SECONDS")
+    if not (unchanged and cache.touch(cache_key, timeout=stale_ttl)):
+        cache.set(cache_key, catalog, timeout=stale_ttl)
+    cache.set(_cfg("FRESH_KEY"), catalog["etag"], timeout=_jittered_ttl("CACHE_TTL_SECONDS"))
+
+
+def _keep_local_copy(catalog, source):
+    global _local_copy
+    _local_copy = (catalog, source, time.monotonic() + float(_cfg("LOCAL_TTL_SECONDS")))
+
+
+def _refresh_in_background(request, previous):
+    """
+    Runs on _REFRESH_EXECUTOR while requests keep getting the stale catalog
+    (`previous`). On failure that value stays in cache; the next request retries.
+    """
+    try:
+        catalog = _encode_catalog(_fetch_all_courses(request), previous)
+        _store_catalog(catalog, unchanged=catalog is previous)
+    except Exception as exc:
+        log.exception("course_catalog_cache background refresh failed: %s", exc)
+    finally:
+        cache.delete(_cfg("LOCK_KEY"))
+        close_old_connections()  # pool threads outlive requests; don't leak DB connections
 
 
 @require_GET
-@never_cache  # we handle caching via Redis/Django cache; avoid intermediate caches
+# we handle caching via Redis/Django cache; avoid intermediate caches, but let
+# clients keep the body and revalidate it with If-None-Match
+@cache_control(private=True, no_cache=True)
 def courses_all(request):
     """
     GET /api/upvx/courses/all
 
     Returns all courses (no pagination) as {results:[...]}.
     """
-    cache_key = _cfg("CACHE_KEY")
-    stale_key = _cfg("STALE_KEY")
+    cache_key = _catalog_key()
+    fresh_key = _cfg("FRESH_KEY")
     lock_key = _cfg("LOCK_KEY")
-
-    # 1) Fresh cache
-    cached = cache.get(cache_key)
-    if cached is not None:
-        return _json_response(cached, source="cache")
-
-    # 2) Refresh with distributed lock
-    got_lock = cache.add(lock_key, "1", timeout=int(_cfg("LOCK_TTL_SECONDS")))
+    lock_ttl = int(_cfg("LOCK_TTL_SECONDS"))
+
+    # 0) Per-process copy: no cache round-trip at all while it is recent, and
+    # only the small FRESH_KEY read to confirm it is still current after that.
+    # Stale copies are kept too, so a long refresh window (e.g. upstream down)
+    # costs each process a few round-trips per LOCAL_TTL_SECONDS, not per request
+    local_catalog, local_source, local_expiry = _local_copy
+    if local_catalog is not None:
+        if time.monotonic() < local_expiry:
+            return _json_response(request, local_catalog, source=local_source)
+
+        if cache.get(fresh_key) == local_catalog["etag"]:
+            _keep_local_copy(local_catalog, "cache")
+            return _json_response(request, local_catalog, source="cache")
+
+    # All refresh state in one round-trip (a single MGET on Redis backends)
+    state = cache.get_many([cache_key, fresh_key, lock_key])
+    # cache.add stays the atomic arbiter; this only skips it when clearly taken
+    lock_held = lock_key in state
+
+    # 1) Cached catalog: serve it right away, refreshing in background if expired
+    catalog = state.get(cache_key)
+    if catalog is not None:
+        if state.get(fresh_key) == catalog["etag"]:
+            _keep_local_copy(catalog, "cache")
+            return _json_response(request, catalog, source="cache")
+
+        if not lock_held and cache.add(lock_key, "1", timeout=lock_ttl):
+            _REFRESH_EXECUTOR.submit(_refresh_in_background, request, catalog)
+        _keep_local_copy(catalog, "stale")
+        return _json_response(request, catalog, source="stale")
+
+    # 2) Cold cache: refresh inline with distributed lock
+    got_lock = not lock_held and cache.add(lock_key, "1", timeout=lock_ttl)
 
     if got_lock:
         try:
-            results = _fetch_all_courses_from_courses_api(request)
-
-            cache.set(cache_key, results, timeout=int(_cfg("CACHE_TTL_SECONDS")))
-            cache.set(stale_key, results, timeout=int(_cfg("STALE_TTL_SECONDS")))
+            catalog = _encode_catalog(_fetch_all_courses(request))
+            _store_catalog(catalog)
+            _keep_local_copy(catalog, "cache")
 
-            return _json_response(results, source="fresh")
+            return _json_response(request, catalog, source="fresh")
 
         except Exception as exc:
             log.exception("course_catalog_cache refresh failed: %s", exc)
 
-            stale = cache.get(stale_key)
-            if stale is not None:
-                return _json_response(stale, source="stale", http_status=200)
-
             return JsonResponse(
                 {
                     "detail": "Could not refresh courses catalog and no stale cache available.",
@@ -144,16 +464,7 @@ def courses_all(request):
         finally:
             cache.delete(lock_key)
 
-    # 3) Someone else is refreshing: serve stale if possible
-    stale = cache.get(stale_key)
-    if stale is not None:
-        return _json_response(stale, source="stale")
-
-    # 4) Warmup fallback (no stale yet)
-    cached2 = cache.get(cache_key)
-    if cached2 is not None:
-        return _json_response(cached2, source="cache")
-
+    # 3) Warmup: someone else is refreshing, the client retries
     return JsonResponse(
         {"detail": "Courses catalog is warming up. Please retry.", "generated_at": _now_iso()},
         status=503,